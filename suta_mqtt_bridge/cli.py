@@ -13,10 +13,19 @@ import asyncio
 import sys
 import yaml
 
-from suta_mqtt_bridge import SutaMqttBridge
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
-import time
-time.sleep(5)
+try:
+    # Optional, but a faster event loop if it is installed
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from .mqtt_suta_bed import MqttSutaBed
+from .suta_mqtt_bridge import SutaMqttBridge
 
 def main():
     parser = argparse.ArgumentParser(
@@ -41,9 +50,15 @@ def main():
     parser.add_argument("-i", "--update-interval", type=int, default=30,
         help="Frequency at which to send out update messages, in seconds.")
 
+    parser.add_argument("--step-interval", type=float, default=MqttSutaBed.MIN_STEP_INTERVAL_S,
+        help="Time to leave between movement commands sent to the bed, in seconds. Too short and the bed may miss commands, making the reported position drift.")
+
     parser.add_argument("--discovery-prefix", default="homeassistant",
         help="MQTT discovery prefix.")
 
+    parser.add_argument("--cache-file",
+        help="Path to a file in which to remember known devices between runs, so they can be reconnected without waiting for the MQTT broker.")
+
     parser.add_argument("--adapter", required=False, type=str, default=None,
         help="Bluetooth adapter to select, like \"hci0\"")
 
@@ -52,7 +67,7 @@ def main():
 
     if args.config_file:
         with open(args.config_file, "r", encoding="utf-8") as config_file:
-            config = yaml.safe_load(config_file)
+            config = yaml.load(config_file, Loader=SafeLoader) or {}
 
     for arg in vars(args):
         val = getattr(args, arg)
@@ -64,7 +79,11 @@ def main():
     del config["config_file"]
 
     controller = SutaMqttBridge(**config)
-    asyncio.run(controller.start()) # Should never return
+    if uvloop is not None:
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            runner.run(controller.start()) # Should never return
+    else:
+        asyncio.run(controller.start()) # Should never return
 
 
 if __name__ == "__main__":
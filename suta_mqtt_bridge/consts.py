@@ -8,11 +8,30 @@
 # Description: Constants used within the ember-mqtt-bridge project
 #
 
-from typing import Dict, NamedTuple
+from typing import Any, Dict, NamedTuple, Union
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    import json
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    json_loads = json.loads
 
 SUTA_MANUFACTURER = "suta"
 
 class MqttPayload(NamedTuple):
     topic: str
-    payload: Dict[str, str]
+    # Either a dict to be JSON-encoded, or an already-encoded payload
+    payload: Union[Dict[str, Any], bytes]
     retain: bool = True
+
+    def encoded(self) -> bytes:
+        """
+        Return the payload serialised as it should be sent over the wire
+        """
+        if isinstance(self.payload, bytes):
+            return self.payload
+        return json_dumps(self.payload)
@@ -7,14 +7,16 @@
 # Description: Mqtt handler for arbitary devices
 #
 
-from consts import MqttPayload
-from mqtt_device import MqttDevice
+from .consts import MqttPayload, json_dumps, json_loads
+from .mqtt_device import MqttDevice
 
 import asyncio
+from functools import partial
 from aiomqtt import Client, MqttError
-import json
+import hashlib
 import logging
-from typing import Dict, Set, List
+import os
+from typing import Awaitable, Callable, Dict, Set, List, Optional, Tuple
 
 class MqttBridge:
     def __init__(
@@ -26,6 +28,7 @@ class MqttBridge:
         discovery_prefix,
         command_prefix,
         manufacturer_strings,
+        cache_file: Optional[str] = None,
         **kwargs
         ):
         """
@@ -38,6 +41,7 @@ class MqttBridge:
         @param discovery_prefix: Prefix expected to discover existing devices
         @param command_prefix: Prefix expected when receiving commands
         @param manufacturer_strings: Strings to use to identify devices controlled by this bridge
+        @param cache_file: Optional path to a file in which to remember known devices between runs
         """
         self.mqtt_broker = mqtt_broker
         self.mqtt_broker_port = mqtt_broker_port
@@ -52,20 +56,24 @@ class MqttBridge:
 
         # Devices to which we are connected and controlling
         self.tracked_devices: Dict[str, MqttDevice] = {}
-        self.incoming_tracked_devices: Dict[str, MqttDevice] = {}
-        self.outgoing_tracked_devices: Set[str] = set()
         # Devices which we can see but with which we are not supposed to talk
         self.unpaired_devices: Dict[str, MqttDevice] = {}
-        self.incoming_unpaired_devices: Dict[str, MqttDevice] = {}
-        self.outgoing_unpaired_devices: Set[str] = set()
+        # All tracked and unpaired devices, keyed by each of their command topics, for dispatching commands
+        self._devices_by_command_topic: Dict[str, MqttDevice] = {}
 
-        self.new_device_event = asyncio.Event()
-        self.done_processing_new_devices = asyncio.Event()
-        self.done_processing_new_devices.set()
+        # Pending changes to the above, as (op, kind, key, device), applied in order by start_device_listener
+        self._device_ops: asyncio.Queue[Tuple[str, str, str, Optional[MqttDevice]]] = asyncio.Queue()
 
-        self.outgoing_messages = asyncio.Queue()
+        # The connected client, while we have one
+        self._client: Optional[Client] = None
+
+        # Digest of the last discovery payload we published to each discovery topic
+        self._published_discovery: Dict[str, bytes] = {}
+        # Last state payload we published to each state topic
+        self._last_state: Dict[str, bytes] = {}
 
         self.retry_interval_secs = 1
+        self.max_retry_interval_secs = 30
 
         self.logger = logging.getLogger(__name__)
 
@@ -73,16 +81,27 @@ class MqttBridge:
         # but with which we may or may not be connected.
         self.known_devices: Set[str] = set()
         self.done_processing_existing_known_devices_event = asyncio.Event()
+        # Retained discovery messages are considered done once none have arrived for this long
+        self.known_devices_settle_secs = 0.5
+        self._last_discovery_msg_at = 0.0
+
+        self.cache_file = cache_file
+        if self._load_known_devices():
+            # No need to wait for the broker to replay its retained messages before we start,
+            # anything new learned from those will still be picked up as it arrives.
+            self.done_processing_existing_known_devices_event.set()
 
     def validate_parameters(self):
-        unsupplied_params = [var for var in vars(self) if getattr(self, var) is None]
+        if all(value is not None for value in vars(self).values()):
+            return
 
-        if len(unsupplied_params) > 0:
-            raise ExceptionGroup(
-                "One or more parameters was not provided",
-                [ValueError(param) for param in unsupplied_params])
+        unsupplied_params = [var for var, value in vars(self).items() if value is None]
+        raise ExceptionGroup(
+            "One or more parameters was not provided",
+            [ValueError(param) for param in unsupplied_params])
 
     async def start(self):
+        failed_attempts = 0
         while True:
             try:
                 async with Client(
@@ -91,27 +110,53 @@ class MqttBridge:
                     username=self.mqtt_username,
                     password=self.mqtt_password,
                     ) as client:
+                    failed_attempts = 0
+                    # We cannot be sure what the broker retained while we were away
+                    self._published_discovery.clear()
+                    self._last_state.clear()
+                    self._last_discovery_msg_at = asyncio.get_running_loop().time()
+                    self._client = client
                     try:
                         async with asyncio.TaskGroup() as tg:
+                            tg.create_task(self._latch_known_devices())
                             tg.create_task(self.start_mqtt_listener(client))
                             tg.create_task(self.start_device_listener(client))
-                            tg.create_task(self.start_outgoing_message_handler(client))
-                    except:
+                    except (Exception, asyncio.CancelledError):
+                        self._client = None
                         # We are closing down. Send out a notice that the devices we control are offline.
-                        for mqtt_device in self.tracked_devices.values():
-                            await self._remove_tracked_device(client, mqtt_device)
-                        for mqtt_device in self.unpaired_devices.values():
-                            await self._remove_unpaired_device(client, mqtt_device)
+                        await asyncio.gather(
+                            *(self._remove_tracked_device(client, mqtt_device) for mqtt_device in self.tracked_devices.values()),
+                            *(self._remove_unpaired_device(client, mqtt_device) for mqtt_device in self.unpaired_devices.values()),
+                            )
                         raise
             except MqttError as err:
-                self.logger.warning(f"MQTT connection failed with {err}")
-                await asyncio.sleep(self.retry_interval_secs)
+                # Back off exponentially so that we do not hammer a broker which is still starting up
+                retry_delay = min(self.retry_interval_secs * 2 ** failed_attempts, self.max_retry_interval_secs)
+                failed_attempts += 1
+                self.logger.warning(f"MQTT connection failed with {err}, retrying in {retry_delay}s")
+                await asyncio.sleep(retry_delay)
+
+    async def _latch_known_devices(self) -> None:
+        """
+        Signal that the existing known devices have been processed, once discovery messages stop arriving
+        """
+        loop = asyncio.get_running_loop()
+        while not self.done_processing_existing_known_devices_event.is_set():
+            remaining = self._last_discovery_msg_at + self.known_devices_settle_secs - loop.time()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            else:
+                self.done_processing_existing_known_devices_event.set()
 
     async def start_mqtt_listener(self, mqtt: Client):
+        loop = asyncio.get_running_loop()
         await mqtt.subscribe(f"{self.discovery_prefix}/#") # Listen for knowledge of device we cannot see
+        # Listen for commands to all of our devices at once. Device topic roots are {command_prefix}/{device}.
+        await mqtt.subscribe(f"{self.command_prefix}/+/+/set")
         async for message in mqtt.messages:
             topic = message.topic.value
-            if topic.startswith(f"{self.discovery_prefix}"):
+            if topic.startswith(self.discovery_prefix):
+                self._last_discovery_msg_at = loop.time()
                 '''
                 Look for MQTT messages indicating devices which have been discovered in the past,
                 which we should be on the lookout for.
@@ -119,39 +164,34 @@ class MqttBridge:
                 so we _cannot_ expect that they are paired.
                 '''
                 if message.payload and message.retain != 0:
-                    data = json.loads(message.payload)
+                    data = json_loads(message.payload)
                     if data and "device" in data:
                         device = data["device"]
                         if "connections" in device and "manufacturer" in device:
                             if device["manufacturer"] in self.manufacturer_strings:
                                 connections = device["connections"]
-                                self.known_devices.add(connections[0][1])
-                elif message.payload is None:
+                                address = connections[0][1]
+                                if address not in self.known_devices:
+                                    self.known_devices.add(address)
+                                    self._save_known_devices()
+                elif not message.payload:
                     # This is a device which is being deleted
+                    self._published_discovery.pop(topic, None)
                     # TODO: Handle this case, so that we don't immediately re-discover mugs which the user has tried to delete.
-                    pass
                 else:
                     # Non-retained messages indicate a device which is not "known", maybe in pairing state at best.
                     pass
-            if len(mqtt.messages) == 0:
-                self.done_processing_existing_known_devices_event.set()
 
             if topic.startswith(self.command_prefix) and topic.endswith("set"):
                 '''
                 Look for messages indicating a command from the user.
-                TODO: Make this section gracefully accept devices which are handled by another MQTT instance
                 '''
-                # Get the device to which this message belongs
-                # There is certainly a better way to do this but I am lazy
-                matching_devices = [mqtt_device for mqtt_device in self.tracked_devices.values() if topic.startswith(mqtt_device.topic_root())]
-                matching_devices = matching_devices + [mqtt_device for mqtt_device in self.unpaired_devices.values() if topic.startswith(mqtt_device.topic_root())]
-                if len(matching_devices) == 0:
-                    logging.error(f"No devices matched {topic}. This is a bug.")
-                elif len(matching_devices) > 1:
-                    logging.error(f"More than one device matched {topic}. This is a bug.")
+                # Get the device to which this message belongs.
+                mqtt_device = self._devices_by_command_topic.get(topic)
+                if mqtt_device is None:
+                    # Probably a device handled by another bridge on the same MQTT server
+                    self.logger.debug(f"No devices matched {topic}, ignoring.")
                 else:
-                    mqtt_device = matching_devices[0]
-
                     try:
                         await mqtt_device.handle_command(self, topic, message.payload.decode())
                     except Exception as e:
@@ -160,115 +200,173 @@ class MqttBridge:
     
     async def start_device_listener(self, mqtt) -> None:
         """
-        Handle events indicating a new device has been added
+        Handle events indicating a device has been added or removed
         """
         while True:
-            await self.new_device_event.wait()
-            self.new_device_event.clear()
-            self.done_processing_new_devices.clear()
-
-            for key in self.incoming_unpaired_devices:
-                device = self.incoming_unpaired_devices[key]
-                self.unpaired_devices[key] = device
-                await self.subscribe_mqtt_topic(mqtt, device)
-                await self.send_unpaired_entity_discovery(mqtt, device)
-
-            self.incoming_unpaired_devices = {}
-
-            for key in self.outgoing_unpaired_devices:
-                device = self.unpaired_devices[key]
-                await self.unsubscribe_mqtt_topic(mqtt, device)
-                await self._remove_unpaired_device(mqtt, device)
-                del self.unpaired_devices[key]
-
-            self.outgoing_unpaired_devices = set()
-
-            for key in self.incoming_tracked_devices:
-                device = self.incoming_tracked_devices[key]
-                self.tracked_devices[key] = device
-                await self.subscribe_mqtt_topic(mqtt, device)
-                await self.send_entity_discovery(mqtt, device)
-                await self.enqueue_update(device, online=True)
-
-            self.incoming_tracked_devices = {}
-
-            for key in self.outgoing_tracked_devices:
-                device = self.tracked_devices[key]
-                await self.unsubscribe_mqtt_topic(mqtt, device)
-                await self._remove_unpaired_device(mqtt, device)
-                del self.tracked_devices[key]
-
-            self.outgoing_tracked_devices = set()
+            # Apply every change which has queued up in one pass, then publish the results in one burst
+            ops = [await self._device_ops.get()]
+            while not self._device_ops.empty():
+                ops.append(self._device_ops.get_nowait())
+
+            # Messages for any one device must go out in order, but different devices need not wait on each other.
+            # Steps are only turned into coroutines when their turn comes, so none are left un-awaited if an earlier one fails.
+            pending: Dict[str, List[Callable[[], Awaitable[None]]]] = {}
+            removed: List[Tuple[str, MqttDevice]] = []
+            for op, kind, key, device in ops:
+                devices = self.tracked_devices if kind == "tracked" else self.unpaired_devices
+                steps = pending.setdefault(key, [])
+
+                if op == "add":
+                    replaced = devices.get(key)
+                    devices[key] = device
+                    if replaced is not None and replaced is not device:
+                        # Another object for the same device, such as a stale unpaired bed paired over the one we connected to
+                        self._unroute_commands(replaced)
+                        removed.append((key, replaced))
+                    self._devices_by_command_topic.update(dict.fromkeys(device.command_topics(), device))
+                    if kind == "tracked":
+                        steps.append(partial(self.send_entity_discovery, mqtt, device))
+                        steps.append(partial(self.publish_update, device, online=True))
+                    else:
+                        steps.append(partial(self.send_unpaired_entity_discovery, mqtt, device))
+                else:
+                    device = devices.pop(key, None)
+                    if device is None:
+                        # Already removed by an earlier event
+                        continue
+                    if kind == "tracked":
+                        steps.append(partial(self.publish_update, device, online=False))
+                    steps.append(partial(self._remove_unpaired_device, mqtt, device))
+                    self._unroute_commands(device)
+                    removed.append((key, device))
+
+            # A device may have just moved between tracked and unpaired (pairing), so only close those which are really gone
+            closing: Dict[str, List[MqttDevice]] = {}
+            for key, device in removed:
+                if self.tracked_devices.get(key) is not device and self.unpaired_devices.get(key) is not device:
+                    closing.setdefault(key, []).append(device)
+
+            await asyncio.gather(*(self._run_in_order(steps, closing.get(key, [])) for key, steps in pending.items()))
+
+    def _unroute_commands(self, device: MqttDevice) -> None:
+        """
+        Stop dispatching commands to this device
+        """
+        for command_topic in device.command_topics():
+            # The same address may also be registered as another device object, which now owns the topic
+            if self._devices_by_command_topic.get(command_topic) is device:
+                del self._devices_by_command_topic[command_topic]
 
-            self.done_processing_new_devices.set()
+    @staticmethod
+    async def _run_in_order(steps: List[Callable[[], Awaitable[None]]], closing: List[MqttDevice]) -> None:
+        """
+        Run each step in turn, then close the devices which are going away, even if one of the steps failed
+        """
+        try:
+            for step in steps:
+                await step()
+        finally:
+            for device in closing:
+                await device.close()
+
+    def _load_known_devices(self) -> bool:
+        """
+        Seed known_devices from the cache file
 
-    async def start_outgoing_message_handler(self, mqtt) -> None:
-        while True:
-            message: MqttPayload = await self.outgoing_messages.get()
-            await mqtt.publish(message.topic, json.dumps(message.payload), retain=message.retain)
+        @return: True if the cache file was read
+        """
+        if self.cache_file is None:
+            return False
+        try:
+            with open(self.cache_file, "rb") as cache:
+                addresses = json_loads(cache.read())
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as err:
+            self.logger.warning(f"Ignoring unreadable device cache {self.cache_file}: {err}")
+            return False
+        if not isinstance(addresses, list) or not all(isinstance(address, str) for address in addresses):
+            self.logger.warning(f"Ignoring device cache {self.cache_file}: expected a list of addresses")
+            return False
+        self.known_devices.update(addresses)
+        return True
+
+    def _save_known_devices(self) -> None:
+        """
+        Write known_devices to the cache file, replacing it atomically
+        """
+        if self.cache_file is None:
+            return
+        temp_file = f"{self.cache_file}.tmp"
+        try:
+            with open(temp_file, "wb") as cache:
+                cache.write(json_dumps(sorted(self.known_devices)))
+            os.replace(temp_file, self.cache_file)
+        except OSError as err:
+            self.logger.warning(f"Could not write device cache {self.cache_file}: {err}")
 
     async def add_tracked_device(self, key: str, device: MqttDevice) -> None:
-        await self.done_processing_new_devices.wait()
-        self.incoming_tracked_devices[key] = device
-        self.new_device_event.set()
+        await self._device_ops.put(("add", "tracked", key, device))
 
     async def remove_tracked_device(self, key:str) -> None:
-        await self.done_processing_new_devices.wait()
-        device = self.tracked_devices[key]
-        await self.enqueue_update(device, online=False)
-        self.outgoing_tracked_devices.add(key)
-        self.new_device_event.set()
+        await self._device_ops.put(("remove", "tracked", key, None))
 
     async def add_unpaired_device(self, key: str, device: MqttDevice) -> None:
-        await self.done_processing_new_devices.wait()
-        self.incoming_unpaired_devices[key] = device
-        self.new_device_event.set()
+        await self._device_ops.put(("add", "unpaired", key, device))
 
     async def remove_unpaired_device(self, key:str) -> None:
-        await self.done_processing_new_devices.wait()
-        self.outgoing_unpaired_devices.add(key)
-        self.new_device_event.set()
+        await self._device_ops.put(("remove", "unpaired", key, None))
 
-    async def enqueue_update(self, device: MqttDevice, online: bool) -> None:
+    async def publish_update(self, device: MqttDevice, online: bool) -> None:
         """
-        Request an update message be sent
+        Publish the device's current state, unless it is identical to the last one sent for this device
         """
         state = await device.get_update(online=online)
-        await self.outgoing_messages.put(state)
+        payload = state.encoded()
+        if self._last_state.get(state.topic) == payload:
+            return
+        client = self._client
+        if client is None:
+            # Not connected. Reconnecting clears _last_state, so the next update will go out.
+            return
+        try:
+            await client.publish(state.topic, payload, retain=state.retain)
+        except MqttError as err:
+            self.logger.warning(f"Failed to publish update to {state.topic}: {err}")
+            return
+        self._last_state[state.topic] = payload
 
     async def _remove_tracked_device(self, mqtt: Client, device: MqttDevice) -> None:
         message: MqttPayload = await device.get_update(online=False)
-        await mqtt.publish(message.topic, json.dumps(message.payload), retain=message.retain)
+        await mqtt.publish(message.topic, message.encoded(), retain=message.retain)
 
     async def _remove_unpaired_device(self, mqtt: Client, device: MqttDevice) -> None:
         entities: List[MqttPayload] = device.get_unpaired_entities(discovery_prefix=self.discovery_prefix)
         for entity in entities:
-            await mqtt.publish(entity.topic, None, retain=False)
-
-    async def subscribe_mqtt_topic(self, mqtt: Client, device: MqttDevice):
-        '''
-        Subscribe to the update topics for the given device.
-        '''
-        await mqtt.subscribe(f"{device.topic_root()}/+/set")
-
-    async def unsubscribe_mqtt_topic(self, mqtt: Client, device: MqttDevice):
-        '''
-        Unsubscribe from the update topics for the given device.
-        '''
-        await mqtt.unsubscribe(f"{device.topic_root()}/+/set")
+            self._published_discovery.pop(entity.topic, None)
+        await asyncio.gather(*(mqtt.publish(entity.topic, None, retain=False) for entity in entities))
 
     async def send_unpaired_entity_discovery(self, mqtt: Client, device: MqttDevice):
         '''
         Broadcast this device in unpaired mode
         '''
         entities: List[MqttPayload] = device.get_unpaired_entities(discovery_prefix=self.discovery_prefix)
-        for entity in entities:
-            await mqtt.publish(entity.topic, json.dumps(entity.payload), retain=False)
+        await asyncio.gather(*(self._publish_discovery(mqtt, entity, retain=False) for entity in entities))
 
     async def send_entity_discovery(self, mqtt: Client, device: MqttDevice):
         '''
         Broadcast this device in normal, ready-to-use mode
         '''
         entities: List[MqttPayload] = device.get_discovery_entities(discovery_prefix=self.discovery_prefix)
-        for entity in entities:
-            await mqtt.publish(entity.topic, json.dumps(entity.payload), retain=entity.retain)
+        await asyncio.gather(*(self._publish_discovery(mqtt, entity, retain=entity.retain) for entity in entities))
+
+    async def _publish_discovery(self, mqtt: Client, entity: MqttPayload, retain: bool) -> None:
+        '''
+        Publish a discovery entity, unless the same payload is already the last one we sent to its topic
+        '''
+        payload = entity.encoded()
+        digest = hashlib.blake2b(payload, digest_size=8).digest()
+        if self._published_discovery.get(entity.topic) == digest:
+            return
+        await mqtt.publish(entity.topic, payload, retain=retain)
+        self._published_discovery[entity.topic] = digest
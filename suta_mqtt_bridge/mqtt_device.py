@@ -7,21 +7,30 @@
 # Description: Abstract device which is the parent of all MQTT devices handle-able by this bridge
 #
 
-from consts import MqttPayload
+from .consts import MqttPayload
 
 from abc import ABC, abstractmethod
 
-from typing import List
+from typing import Iterable, List
 
 class MqttDevice(ABC):
     """
     Abstract device which is the parent of all MQTT devices handle-able by the MqttBridge
     """
 
+    __slots__ = ()
+
     @abstractmethod
     def topic_root(self) -> str:
         pass
 
+    @abstractmethod
+    def command_topics(self) -> Iterable[str]:
+        """
+        Return every topic on which this device accepts commands
+        """
+        pass
+
     @abstractmethod
     def get_unpaired_entities(self, discovery_prefix: str) -> List[MqttPayload]:
         """
@@ -36,6 +45,12 @@ class MqttDevice(ABC):
         """
         pass
 
+    async def close(self) -> None:
+        """
+        Release anything held by this device. Called once the bridge has stopped using it.
+        """
+        pass
+
     @abstractmethod
     async def handle_command(self, bridge, topic: str, message: str) -> None:
         """
@@ -8,24 +8,74 @@
 #
 
 import asyncio
+import contextlib
 
 from suta_ble_bed import BleSutaBed
 
-from mqtt_device import MqttDevice
-from consts import MqttPayload, SUTA_MANUFACTURER
+from .mqtt_device import MqttDevice
+from .consts import MqttPayload, SUTA_MANUFACTURER, json_dumps
 
 import logging
-from typing import List
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
 # Experimentally determined. Number of times you need to send "raise_head" to get the bed to the top stop.
 HEAD_POSITION_MAX = 39
 FEET_POSITION_MAX = 20
 
+def _cancel_task(task: asyncio.Task) -> None:
+    '''
+    Cancel the task from its own event loop, wherever we are being called from
+    '''
+    loop = task.get_loop()
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(task.cancel)
+
 class MqttSutaBed(MqttDevice):
     '''
     Handle BLE communications and MQTT objects for a SUTA bed frame
     '''
-    def __init__(self, bed: BleSutaBed) -> None:
+    __slots__ = (
+        "bed",
+        "_head_position",
+        "_feet_position",
+        "target_head_position",
+        "target_feet_position",
+        "target_position_changed",
+        "_step_interval",
+        "_last_command_at",
+        "_pending_preset",
+        "_sanitised_mac",
+        "_topic_root",
+        "_state_topic",
+        "_pairing_cmd",
+        "_head_control_cmd",
+        "_raise_head_cmd",
+        "_lower_head_cmd",
+        "_feet_control_cmd",
+        "_raise_feet_cmd",
+        "_lower_feet_cmd",
+        "_flat_cmd",
+        "_lounge_cmd",
+        "_handlers",
+        "_device_definition",
+        "_unpaired_entities",
+        "_discovery_entities",
+        "_last_state_tuple",
+        "_last_update",
+        "should_exit_task",
+        "position_update_loop_task",
+    )
+
+    # Shortest gap between movement commands at which the bed reliably registers each one. Positions are
+    # tracked by counting commands, so a dropped command leaves the reported position wrong.
+    MIN_STEP_INTERVAL_S: float = 0.5
+
+    def __init__(self, bed: BleSutaBed, step_interval: float = MIN_STEP_INTERVAL_S) -> None:
+        """
+
+        @param bed: Bed to control
+        @param step_interval: Seconds to leave between consecutive movement commands
+        """
         self.bed: BleSutaBed = bed
 
         self._head_position: int = 0
@@ -34,100 +84,228 @@ class MqttSutaBed(MqttDevice):
         self.target_head_position: int = 0
         self.target_feet_position: int = 0
         self.target_position_changed = asyncio.Event()
+        # Time to leave between consecutive movement commands, so that the bed registers each of them
+        self._step_interval: float = step_interval
+        # Event loop time at which we last sent the bed a movement command
+        self._last_command_at: float = 0.0
+        # Preset (flat, lounge, ...) requested by the user, to be sent by position_update_loop
+        self._pending_preset: Optional[Callable[[], Awaitable[None]]] = None
+        # Inputs to, and result of, the last get_update call, so an unchanged state isn't rebuilt
+        self._last_state_tuple: Optional[Tuple[bool, int, int]] = None
+        self._last_update: Optional[MqttPayload] = None
+
+        # Topics are derived from the address, which never changes, so only format them once
+        self._sanitised_mac = self.bed.device.address.replace(":", "_")
+        self._topic_root = f"{SUTA_MANUFACTURER}/{self._sanitised_mac}"
+        self._state_topic = f"{self._topic_root}/state"
+        self._pairing_cmd = f"{self._topic_root}/pairing_button/set"
+        self._head_control_cmd = f"{self._topic_root}/head_control/set"
+        self._raise_head_cmd = f"{self._topic_root}/raise_head/set"
+        self._lower_head_cmd = f"{self._topic_root}/lower_head/set"
+        self._feet_control_cmd = f"{self._topic_root}/feet_control/set"
+        self._raise_feet_cmd = f"{self._topic_root}/raise_feet/set"
+        self._lower_feet_cmd = f"{self._topic_root}/lower_feet/set"
+        self._flat_cmd = f"{self._topic_root}/flat/set"
+        self._lounge_cmd = f"{self._topic_root}/lounge/set"
+
+        # Command topic -> coroutine handling it, called with (bridge, message)
+        self._handlers: Dict[str, Callable[[Any, str], Awaitable[None]]] = {
+            self._pairing_cmd: self._on_pairing,
+            self._raise_head_cmd: self._on_raise_head,
+            self._lower_head_cmd: self._on_lower_head,
+            self._head_control_cmd: self._on_head_control,
+            self._raise_feet_cmd: self._on_raise_feet,
+            self._lower_feet_cmd: self._on_lower_feet,
+            self._feet_control_cmd: self._on_feet_control,
+            self._flat_cmd: self._on_flat,
+            self._lounge_cmd: self._on_lounge,
+        }
+
+        # None of these depend on anything which changes over the lifetime of the device,
+        # so build them once. The entity lists are keyed by discovery prefix.
+        self._device_definition = {
+            # This connection may strictly not be a MAC if you are (for instance) running on
+            # MacOS where Bleak isn't allowed to acces the MAC information.
+            "name": self.bed.device.name,
+            "connections": [["mac", self.bed.device.address]],
+            "model": self.bed.device.name,
+            "manufacturer": SUTA_MANUFACTURER,
+            "suggested_area": "Bedroom",
+        }
+        self._unpaired_entities: Dict[str, List[MqttPayload]] = {}
+        self._discovery_entities: Dict[str, List[MqttPayload]] = {}
 
         self.should_exit_task = False
         self.position_update_loop_task = asyncio.create_task(self.position_update_loop())
 
     def __del__(self) -> None:
+        # Last resort for when nobody called close(). This may run from the garbage collector at any point,
+        # so only ask the event loop to cancel the task rather than touching it from here.
+        _cancel_task(self.position_update_loop_task)
+
+    async def close(self) -> None:
         self.should_exit_task = True
-        self.target_position_changed.set()
         self.position_update_loop_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self.position_update_loop_task
+
+    async def ensure_connected(self) -> None:
+        '''
+        Connect to the bed, if we are not already. The connection, along with the services discovered on it,
+        is kept by the bed and re-used by every command until it drops.
+        suta_ble_bed has no public way to do this, hence the version bound in requirements.txt.
+        '''
+        await self.bed._ensure_connection()
+
+    async def disconnect(self) -> None:
+        '''
+        Drop the connection to the bed, if there is one
+        '''
+        if self.bed.is_connected():
+            self.bed._expected_disconnect = True
+            await self.bed._client.disconnect()
+
+    def command_topics(self) -> Iterable[str]:
+        return self._handlers.keys()
 
     def sanitised_mac(self) -> str:
         '''
         Return my connection address in a form which is suitable where colons aren't
         '''
-        return self.bed.device.address.replace(":", "_")
+        return self._sanitised_mac
 
     def get_device_definition(self):
-        return {
-            # This connection may strictly not be a MAC if you are (for instance) running on
-            # MacOS where Bleak isn't allowed to acces the MAC information.
-            "name": self.bed.device.name,
-            "connections": [("mac", self.bed.device.address)],
-            "model": self.bed.device.name,
-            "manufacturer": SUTA_MANUFACTURER,
-            "suggested_area": "Bedroom",
-        }
+        return self._device_definition
 
     def topic_root(self) -> str:
-        return f"{SUTA_MANUFACTURER}/{self.sanitised_mac()}"
+        return self._topic_root
 
     def state_topic(self) -> str:
-        return f"{self.topic_root()}/state"
+        return self._state_topic
 
     def pairing_button_command_topic(self) -> str:
-        return f"{self.topic_root()}/pairing_button/set"
+        return self._pairing_cmd
 
     def head_control_command_topic(self) -> str:
-        return f"{self.topic_root()}/head_control/set"
+        return self._head_control_cmd
 
     def raise_head_button_command_topic(self) -> str:
-        return f"{self.topic_root()}/raise_head/set"
+        return self._raise_head_cmd
 
     def lower_head_button_command_topic(self) -> str:
-        return f"{self.topic_root()}/lower_head/set"
+        return self._lower_head_cmd
 
     def feet_control_command_topic(self) -> str:
-        return f"{self.topic_root()}/feet_control/set"
+        return self._feet_control_cmd
 
     def raise_feet_button_command_topic(self) -> str:
-        return f"{self.topic_root()}/raise_feet/set"
+        return self._raise_feet_cmd
 
     def lower_feet_button_command_topic(self) -> str:
-        return f"{self.topic_root()}/lower_feet/set"
+        return self._lower_feet_cmd
 
     def flat_button_command_topic(self) -> str:
-        return f"{self.topic_root()}/flat/set"
+        return self._flat_cmd
 
     def lounge_button_command_topic(self) -> str:
-        return f"{self.topic_root()}/lounge/set"
+        return self._lounge_cmd
 
     async def position_update_loop(self) -> None:
         while True:
             await self.target_position_changed.wait()
             if (self.should_exit_task): return
-            if self.target_head_position != self._head_position and self.target_feet_position != self._feet_position:
-                # TODO: Move both head and feet at the same time
-                pass
-            if self.target_head_position != self._head_position:
-                if self.target_head_position > self._head_position:
-                    await self.bed.raise_head()
-                    self._head_position = min(self._head_position + 1, HEAD_POSITION_MAX)
-                elif self.target_head_position < self._head_position:
-                    await self.bed.lower_head()
-                    self._head_position = max(self._head_position - 1, 0)
-            if self.target_feet_position != self._feet_position:
-                if self.target_feet_position > self._feet_position:
-                    await self.bed.raise_feet()
-                    self._feet_position = min(self._feet_position + 1, FEET_POSITION_MAX)
-                elif self.target_feet_position < self._feet_position:
-                    await self.bed.lower_feet()
-                    self._feet_position = max(self._feet_position - 1, 0)
-            if self.target_head_position == self._head_position and self.target_feet_position == self._feet_position:
-                self.target_position_changed.clear()
-            await asyncio.sleep(0.5)
+            while True:
+                # Targets are public, so make sure nobody has set one the bed cannot reach.
+                # Otherwise we would keep sending moves against the end stop forever.
+                self._set_target_head_position(self.target_head_position)
+                self._set_target_feet_position(self.target_feet_position)
+                try:
+                    if self._pending_preset is not None:
+                        preset, self._pending_preset = self._pending_preset, None
+                        await self._send_command(preset)
+                    elif self.target_head_position != self._head_position or self.target_feet_position != self._feet_position:
+                        await self._send_command(self._step_once)
+                    else:
+                        break
+                except Exception as e:
+                    # Give up on this movement. The next command will try again.
+                    logging.warning(f"Error moving {self.bed.device.name}: {e}")
+                    break
+                if (self.should_exit_task): return
+            self.target_position_changed.clear()
+
+    async def _send_command(self, command: Callable[[], Awaitable[None]]) -> None:
+        '''
+        Run a command against the bed, leaving at least _step_interval since the previous one.
+        Nothing waits after the last command of a movement, only before the next one.
+        '''
+        loop = asyncio.get_running_loop()
+        remaining = self._last_command_at + self._step_interval - loop.time()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        try:
+            await command()
+        finally:
+            self._last_command_at = loop.time()
+
+    async def _step_once(self) -> None:
+        '''
+        Move the head and feet one notch each towards their targets
+        '''
+        head_delta = self.target_head_position - self._head_position
+        feet_delta = self.target_feet_position - self._feet_position
+        if head_delta > 0 and feet_delta > 0:
+            # Both going the same way, so a single command moves both
+            await self.bed.raise_head_and_feet()
+            self._head_position = min(self._head_position + 1, HEAD_POSITION_MAX)
+            self._feet_position = min(self._feet_position + 1, FEET_POSITION_MAX)
+        elif head_delta < 0 and feet_delta < 0:
+            await self.bed.lower_head_and_feet()
+            self._head_position = max(self._head_position - 1, 0)
+            self._feet_position = max(self._feet_position - 1, 0)
+        else:
+            await self._step_head(head_delta)
+            await self._step_feet(feet_delta)
+
+    async def _step_head(self, delta: int) -> None:
+        '''
+        Move the head one notch in the direction of delta, if it is non-zero
+        '''
+        if delta > 0:
+            await self.bed.raise_head()
+            self._head_position = min(self._head_position + 1, HEAD_POSITION_MAX)
+        elif delta < 0:
+            await self.bed.lower_head()
+            self._head_position = max(self._head_position - 1, 0)
+
+    async def _step_feet(self, delta: int) -> None:
+        '''
+        Move the feet one notch in the direction of delta, if it is non-zero
+        '''
+        if delta > 0:
+            await self.bed.raise_feet()
+            self._feet_position = min(self._feet_position + 1, FEET_POSITION_MAX)
+        elif delta < 0:
+            await self.bed.lower_feet()
+            self._feet_position = max(self._feet_position - 1, 0)
 
     def get_unpaired_entities(self, discovery_prefix) -> List[MqttPayload]:
+        if discovery_prefix not in self._unpaired_entities:
+            self._unpaired_entities[discovery_prefix] = [
+                entity._replace(payload=entity.encoded()) for entity in self._build_unpaired_entities(discovery_prefix)
+            ]
+        return self._unpaired_entities[discovery_prefix]
+
+    def _build_unpaired_entities(self, discovery_prefix) -> List[MqttPayload]:
         return [
             MqttPayload(
-            topic=f"{discovery_prefix}/button/{self.sanitised_mac()}/pairing_button/config",
+            topic=f"{discovery_prefix}/button/{self._sanitised_mac}/pairing_button/config",
             payload={
                 "name": f"Pair With Device",
                 "device": self.get_device_definition(),
                 "unique_id": f"{self.bed.device.address}_pairing_button",
                 "icon": "mdi:bed",
-                "command_topic": self.pairing_button_command_topic(),
+                "command_topic": self._pairing_cmd,
                 },
             retain=False
             )
@@ -139,163 +317,200 @@ class MqttSutaBed(MqttDevice):
         '''
         await self.bed.flat()
         # Reset positions to known values
-        self.target_position_changed.clear()
         self._feet_position = 0
         self._head_position = 0
         self.target_feet_position = 0
         self.target_head_position = 0
 
     def get_discovery_entities(self, discovery_prefix: str) -> List[MqttPayload]:
+        if discovery_prefix not in self._discovery_entities:
+            self._discovery_entities[discovery_prefix] = [
+                entity._replace(payload=entity.encoded()) for entity in self._build_discovery_entities(discovery_prefix)
+            ]
+        return self._discovery_entities[discovery_prefix]
+
+    def _build_discovery_entities(self, discovery_prefix: str) -> List[MqttPayload]:
+        device_definition = self.get_device_definition()
+        address = self.bed.device.address
+        button_base = f"{discovery_prefix}/button/{self._sanitised_mac}"
+        number_base = f"{discovery_prefix}/number/{self._sanitised_mac}"
         return [
             MqttPayload(
-            topic=f"{discovery_prefix}/button/{self.sanitised_mac()}/raise_head_button/config",
+            topic=f"{button_base}/raise_head_button/config",
             payload={
                 "name": f"Raise head",
-                "device": self.get_device_definition(),
-                "unique_id": f"{self.bed.device.address}_raise_head_button",
+                "device": device_definition,
+                "unique_id": f"{address}_raise_head_button",
                 "icon": "mdi:head",
-                "command_topic": self.raise_head_button_command_topic(),
-                "availability_topic": self.state_topic(),
+                "command_topic": self._raise_head_cmd,
+                "availability_topic": self._state_topic,
                 "availability_template": "{{ value_json.availability }}",
                 "enabled_by_default": True,
                 },
             ),
 
             MqttPayload(
-            topic=f"{discovery_prefix}/button/{self.sanitised_mac()}/lower_head_button/config",
+            topic=f"{button_base}/lower_head_button/config",
             payload={
                 "name": f"Lower head",
-                "device": self.get_device_definition(),
-                "unique_id": f"{self.bed.device.address}_lower_head_button",
+                "device": device_definition,
+                "unique_id": f"{address}_lower_head_button",
                 "icon": "mdi:head",
-                "command_topic": self.lower_head_button_command_topic(),
-                "availability_topic": self.state_topic(),
+                "command_topic": self._lower_head_cmd,
+                "availability_topic": self._state_topic,
                 "availability_template": "{{ value_json.availability }}",
                 "enabled_by_default": True,
                 },
             ),
 
             MqttPayload(
-            topic=f"{discovery_prefix}/number/{self.sanitised_mac()}/head_control/config",
+            topic=f"{number_base}/head_control/config",
             payload={
                 "name": f"Head",
-                "device": self.get_device_definition(),
-                "unique_id": f"{self.bed.device.address}_head_control",
+                "device": device_definition,
+                "unique_id": f"{address}_head_control",
                 "icon": "mdi:head",
                 "min": 0,
                 "max": 100,
                 "unit_of_measurement": "%",
-                "command_topic": self.head_control_command_topic(),
-                "state_topic": self.state_topic(),
+                "command_topic": self._head_control_cmd,
+                "state_topic": self._state_topic,
                 "value_template": "{{ value_json.head_position }}",
-                "availability_topic": self.state_topic(),
+                "availability_topic": self._state_topic,
                 "availability_template": "{{ value_json.availability }}",
                 },
             ),
 
             MqttPayload(
-            topic=f"{discovery_prefix}/button/{self.sanitised_mac()}/raise_feet_button/config",
+            topic=f"{button_base}/raise_feet_button/config",
             payload={
                 "name": f"Raise feet",
-                "device": self.get_device_definition(),
-                "unique_id": f"{self.bed.device.address}_raise_feet_button",
+                "device": device_definition,
+                "unique_id": f"{address}_raise_feet_button",
                 "icon": "mdi:foot-print",
-                "command_topic": self.raise_feet_button_command_topic(),
-                "availability_topic": self.state_topic(),
+                "command_topic": self._raise_feet_cmd,
+                "availability_topic": self._state_topic,
                 "availability_template": "{{ value_json.availability }}",
                 "enabled_by_default": True,
                 },
             ),
 
             MqttPayload(
-            topic=f"{discovery_prefix}/button/{self.sanitised_mac()}/lower_feet_button/config",
+            topic=f"{button_base}/lower_feet_button/config",
             payload={
                 "name": f"Lower feet",
-                "device": self.get_device_definition(),
-                "unique_id": f"{self.bed.device.address}_lower_feet_button",
+                "device": device_definition,
+                "unique_id": f"{address}_lower_feet_button",
                 "icon": "mdi:foot-print",
-                "command_topic": self.lower_feet_button_command_topic(),
-                "availability_topic": self.state_topic(),
+                "command_topic": self._lower_feet_cmd,
+                "availability_topic": self._state_topic,
                 "availability_template": "{{ value_json.availability }}",
                 "enabled_by_default": True,
                 },
             ),
 
             MqttPayload(
-            topic=f"{discovery_prefix}/number/{self.sanitised_mac()}/feet_control/config",
+            topic=f"{number_base}/feet_control/config",
             payload={
                 "name": f"Feet",
-                "device": self.get_device_definition(),
-                "unique_id": f"{self.bed.device.address}_feet_control",
+                "device": device_definition,
+                "unique_id": f"{address}_feet_control",
                 "icon": "mdi:foot-print",
                 "min": 0,
                 "max": 100,
                 "unit_of_measurement": "%",
-                "command_topic": self.feet_control_command_topic(),
-                "state_topic": self.state_topic(),
+                "command_topic": self._feet_control_cmd,
+                "state_topic": self._state_topic,
                 "value_template": "{{ value_json.feet_position }}",
-                "availability_topic": self.state_topic(),
+                "availability_topic": self._state_topic,
                 "availability_template": "{{ value_json.availability }}",
                 },
             ),
 
             MqttPayload(
-            topic=f"{discovery_prefix}/button/{self.sanitised_mac()}/flat_button/config",
+            topic=f"{button_base}/flat_button/config",
             payload={
                 "name": f"Flat",
-                "device": self.get_device_definition(),
-                "unique_id": f"{self.bed.device.address}_flat_button",
+                "device": device_definition,
+                "unique_id": f"{address}_flat_button",
                 "icon": "mdi:seat-flat",
-                "command_topic": self.flat_button_command_topic(),
-                "availability_topic": self.state_topic(),
+                "command_topic": self._flat_cmd,
+                "availability_topic": self._state_topic,
                 "availability_template": "{{ value_json.availability }}",
                 },
             ),
 
             MqttPayload(
-            topic=f"{discovery_prefix}/button/{self.sanitised_mac()}/lounge_button/config",
+            topic=f"{button_base}/lounge_button/config",
             payload={
                 "name": f"Lounge",
-                "device": self.get_device_definition(),
-                "unique_id": f"{self.bed.device.address}_lounge_button",
+                "device": device_definition,
+                "unique_id": f"{address}_lounge_button",
                 "icon": "mdi:seat-flat-angled",
-                "command_topic": self.lounge_button_command_topic(),
-                "availability_topic": self.state_topic(),
+                "command_topic": self._lounge_cmd,
+                "availability_topic": self._state_topic,
                 "availability_template": "{{ value_json.availability }}",
                 "enabled_by_default": True,
                 },
             ),
         ]
 
+    def _set_target_head_position(self, position: int) -> None:
+        '''
+        Set the head target, limited to positions the bed can actually reach
+        '''
+        self.target_head_position = min(max(position, 0), HEAD_POSITION_MAX)
+
+    def _set_target_feet_position(self, position: int) -> None:
+        '''
+        Set the feet target, limited to positions the bed can actually reach
+        '''
+        self.target_feet_position = min(max(position, 0), FEET_POSITION_MAX)
+
     async def handle_command(self, bridge, topic: str, message: str) -> None:
-        if topic == self.pairing_button_command_topic():
-            await bridge.remove_unpaired_device(self.bed.device.address)
-            await bridge.add_tracked_device(self.bed.device.address, self)
-        elif topic == self.raise_head_button_command_topic():
-            self.target_head_position += 1
-        elif topic == self.lower_head_button_command_topic():
-            self.target_head_position -= 1
-        elif topic == self.head_control_command_topic():
-            target_percent = float(message)
-            self.target_head_position = round(HEAD_POSITION_MAX * target_percent/100)
-        elif topic == self.raise_feet_button_command_topic():
-            self.target_feet_position += 1
-        elif topic == self.lower_feet_button_command_topic():
-            self.target_feet_position -= 1
-        elif topic == self.feet_control_command_topic():
-            target_percent = float(message)
-            self.target_feet_position = round(FEET_POSITION_MAX * target_percent/100)
-        elif topic == self.flat_button_command_topic():
-            await self.handle_flat()
-        elif topic == self.lounge_button_command_topic():
-            await self.bed.lounge()
-        else:
+        handler = self._handlers.get(topic)
+        if handler is None:
             logging.error(f"Unknown command: {topic}")
-        pass
+            return
+        await handler(bridge, message)
 
         self.target_position_changed.set()
 
+    async def _on_pairing(self, bridge, message: str) -> None:
+        await bridge.remove_unpaired_device(self.bed.device.address)
+        await bridge.add_tracked_device(self.bed.device.address, self)
+
+    async def _on_raise_head(self, bridge, message: str) -> None:
+        self._set_target_head_position(self.target_head_position + 1)
+
+    async def _on_lower_head(self, bridge, message: str) -> None:
+        self._set_target_head_position(self.target_head_position - 1)
+
+    async def _on_head_control(self, bridge, message: str) -> None:
+        target_percent = float(message)
+        self._set_target_head_position(round(HEAD_POSITION_MAX * target_percent/100))
+
+    async def _on_raise_feet(self, bridge, message: str) -> None:
+        self._set_target_feet_position(self.target_feet_position + 1)
+
+    async def _on_lower_feet(self, bridge, message: str) -> None:
+        self._set_target_feet_position(self.target_feet_position - 1)
+
+    async def _on_feet_control(self, bridge, message: str) -> None:
+        target_percent = float(message)
+        self._set_target_feet_position(round(FEET_POSITION_MAX * target_percent/100))
+
+    async def _on_flat(self, bridge, message: str) -> None:
+        self._pending_preset = self.handle_flat
+
+    async def _on_lounge(self, bridge, message: str) -> None:
+        self._pending_preset = self.bed.lounge
+
     async def get_update(self, online: bool) -> MqttPayload:
+        state_tuple = (online, self._head_position, self._feet_position)
+        if state_tuple == self._last_state_tuple:
+            # Nothing changed, so the previous (already encoded) payload is still accurate
+            return self._last_update
         state = {
             "availability": "online" if online else "offline",
             # Convert the positions back to percentage
@@ -303,7 +518,9 @@ class MqttSutaBed(MqttDevice):
             "feet_position": self._feet_position * 100 // FEET_POSITION_MAX,
         }
         update_payload: MqttPayload = MqttPayload(
-            topic=self.state_topic(),
-            payload=state
+            topic=self._state_topic,
+            payload=json_dumps(state)
         )
+        self._last_state_tuple = state_tuple
+        self._last_update = update_payload
         return update_payload
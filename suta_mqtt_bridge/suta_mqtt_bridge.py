@@ -1,15 +1,17 @@
 """Main module."""
 
 from suta_ble_bed import BleSutaBed
-from mqtt_suta_bed import MqttSutaBed
-from mqtt_bridge import MqttBridge
-from consts import MqttPayload, SUTA_MANUFACTURER
+from .mqtt_suta_bed import MqttSutaBed
+from .mqtt_bridge import MqttBridge
+from .consts import MqttPayload, SUTA_MANUFACTURER
 
 from suta_ble_bed.suta_ble_bed_controller import SutaBleBedController
 
 import asyncio
+import contextlib
 from bleak import BleakError
 import logging
+from typing import Dict, Set, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -19,12 +21,14 @@ class SutaMqttBridge:
         self,
         adapter: str,
         update_interval: int,
+        step_interval: float = MqttSutaBed.MIN_STEP_INTERVAL_S,
         **kwargs
         ):
         """
 
         @param adapter: Bluetooth adapter to use, like "hci0"
         @param update_interval: Frequency at which to refresh the bed state
+        @param step_interval: Seconds to leave between consecutive movement commands sent to a bed
         @param kwargs: Arguments to pass to the MqttBridge constructor
         """
         self.mqtt_bridge = MqttBridge(
@@ -33,70 +37,160 @@ class SutaMqttBridge:
             **kwargs)
         self.adapter = adapter
         self.update_interval = update_interval
-        self.bluetooth_wait_interval_seconds = 10
+        self.step_interval = step_interval
+        # How long a bed may go without advertising before we consider it gone. Allow a whole missed update interval,
+        # so that a bed which advertised just after one check is not dropped at the next.
+        self.device_timeout_seconds = 2 * update_interval
+        self.last_seen: Dict[str, float] = {} # Event loop time at which each bed last advertised, by address
+        self._connect_tasks: Set[asyncio.Task] = set() # Outstanding background connections, kept to avoid them being garbage collected
+        self._connecting: Set[str] = set() # Addresses of devices with a connection in progress
+        # Adapters can only establish a handful of connections at once, so queue up any beyond that
+        self.max_concurrent_connections = 5
+        self._connection_slots = asyncio.Semaphore(self.max_concurrent_connections)
+        # Beds which failed to connect are left alone for a while, backing off exponentially, so that a flaky one can't tie up the adapter
+        self.reconnect_interval_secs = 1
+        self.max_reconnect_interval_secs = 60
+        self._reconnect_backoff: Dict[str, Tuple[float, float]] = {} # Address -> (earliest next attempt, current delay)
 
     async def start(self) -> None:
+        """
+        Run the bridge until cancelled. Install uvloop to have the CLI run this on a faster event loop.
+        """
         async with asyncio.TaskGroup() as tg:
             tg.create_task(self.mqtt_bridge.start())
             tg.create_task(self.start_device_scanning())
+            tg.create_task(self.start_device_polling())
 
     async def start_device_scanning(self) -> None:
         # Wait for existing devices to be populated
         await self.mqtt_bridge.done_processing_existing_known_devices_event.wait()
 
-        async with SutaBleBedController() as controller:
+        loop = asyncio.get_running_loop()
+        # Looked up for every advertisement, so bind them once. The bridge only ever mutates these in place.
+        tracked_devices = self.mqtt_bridge.tracked_devices
+        unpaired_devices = self.mqtt_bridge.unpaired_devices
+        known_devices = self.mqtt_bridge.known_devices
+        connecting = self._connecting
+        last_seen = self.last_seen
+        reconnect_backoff = self._reconnect_backoff
+        async with contextlib.AsyncExitStack() as stack:
+            controller = await stack.enter_async_context(SutaBleBedController(adapter = self.adapter))
+            # Connections are kept for as long as we are scanning. On the way out (in reverse order) stop any connects
+            # still in progress, then drop the connections we hold, and only then stop the scanner.
+            stack.push_async_callback(self._disconnect_tracked_beds)
+            stack.callback(self._cancel_connects)
+
             async for bed in controller.devices():
                 logger.info(f"Discovered {bed.device}")
-                wrapped_bed = MqttSutaBed(bed)
+                address = bed.device.address
+                last_seen[address] = loop.time()
 
-                if bed.device.address in self.mqtt_bridge.known_devices:
+                if address in tracked_devices or address in connecting:
+                    # This is a device we are already tracking, or are in the process of connecting to. Do nothing.
+                    pass
+                elif address in reconnect_backoff and reconnect_backoff[address][0] > last_seen[address]:
+                    # We recently failed to connect to this device. Wait a bit before trying again.
+                    pass
+                elif address in known_devices:
                     # This is a device with which we are paired, either due to the pairing having been broken
                     # or due to another device on the same MQTT network having paired.
                     # Presumably, the user wants us to connect to this device as well.
                     # (To prevent this from hapening, delete the device in Home Assistant or manually remove the MQTT topic.)
-                    await controller.connect(wrapped_bed.bed)
-                    await self.mqtt_bridge.add_tracked_device(key = bed.device.address, device = wrapped_bed)
-                elif bed.device.address in self.mqtt_bridge.tracked_devices:
-                    # This is a device we are already tracking. Do nothing.
-                    pass
-                elif not bed.device.address in self.mqtt_bridge.unpaired_devices:
+                    # Connecting can take a while, so do it in the background rather than stalling discovery.
+                    connecting.add(address)
+                    task = asyncio.create_task(self._connect_and_track(MqttSutaBed(bed, step_interval = self.step_interval)))
+                    self._connect_tasks.add(task)
+                    task.add_done_callback(self._connect_tasks.discard)
+                elif address not in unpaired_devices:
                     # This is a device we have not seen before. Add it as unpaired.
-                    await self.mqtt_bridge.add_unpaired_device(key = bed.device.address, device = wrapped_bed)
+                    await self.mqtt_bridge.add_unpaired_device(key = address, device = MqttSutaBed(bed, step_interval = self.step_interval))
 
                 # Yield the thread to avoid starving anyone else, since the BLE discovery can be noisy
                 await asyncio.sleep(0)
 
+    async def start_device_polling(self) -> None:
+        """
+        Periodically refresh the state of tracked beds, and forget about beds which have gone out of range
+        """
+        loop = asyncio.get_running_loop()
+        # Sleep until a fixed schedule rather than for a fixed time, so a slow pass doesn't push back every later one
+        deadline = loop.time()
         while True:
-            discovered_devices = [device for device in await suta_scanner.discover(mac = None, adapter = self.adapter, wait = self.bluetooth_wait_interval_seconds)]
-            discovered_device_addresses = [device.address for device in discovered_devices]
-            newly_discovered_devices = [device for device in discovered_devices if device.address not in self.mqtt_bridge.tracked_devices and device not in self.mqtt_bridge.unpaired_devices]
-            for device in newly_discovered_devices:
-                pass
-
-            missing_devices = [] # Paired devices which we could not find
-            for addr in self.mqtt_bridge.tracked_devices:
-                device = self.mqtt_bridge.tracked_devices[addr]
-                if addr not in discovered_device_addresses:
-                    # We are supposed to have been controlling this device but it is no longer in range. Mark it as such.
-                    missing_devices.append(addr)
-                else:
-                    try:
-                        await self.mqtt_bridge.enqueue_update(device, online=True)
-                    except BleakError as be:
-                        if addr in self.tracked_mugs:
-                            missing_devices.append(addr)
-                        logging.warning(f"Error while communicating with device: {be}")
+            deadline += self.update_interval
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # We've fallen a whole interval behind. Start the schedule afresh rather than running a burst of passes to catch up.
+                deadline = loop.time()
+                await asyncio.sleep(0)
+
+            # Anything which has not advertised recently is considered out of range
+            cutoff = loop.time() - self.device_timeout_seconds
+            for addr in [addr for addr, seen_at in self.last_seen.items() if seen_at < cutoff]:
+                del self.last_seen[addr]
+                self._reconnect_backoff.pop(addr, None)
+            tracked_devices = self.mqtt_bridge.tracked_devices
+            if not tracked_devices and not self.mqtt_bridge.unpaired_devices:
+                # Nothing to update or clean up
+                continue
+            discovered_device_addresses = self.last_seen.keys()
+            unpaired_device_addresses = self.mqtt_bridge.unpaired_devices.keys()
+
+            # Paired devices which we could not find. We are supposed to have been controlling these but they are no longer in range.
+            # A connected bed may stop advertising, so only those which have also dropped their connection count as missing.
+            missing_devices = {
+                addr for addr, device in tracked_devices.items()
+                if addr not in discovered_device_addresses and not device.bed.is_connected()
+            }
+            present_devices = [(addr, device) for addr, device in tracked_devices.items() if addr not in missing_devices]
+            results = await asyncio.gather(
+                *(self.mqtt_bridge.publish_update(device, online=True) for _, device in present_devices),
+                return_exceptions=True)
+            for (addr, _), result in zip(present_devices, results):
+                if isinstance(result, BaseException):
+                    logger.error(f"Unexpected error while updating {addr}: {result!r}")
 
             for addr in missing_devices:
                 await self.mqtt_bridge.remove_tracked_device(addr)
 
-            gone_unpaired_device_addresses = set()
-            for unpaired_address in self.mqtt_bridge.unpaired_devices:
-                # Clean up any unpaired devices we no longer see
-                if not unpaired_address in discovered_device_addresses:
-                    gone_unpaired_device_addresses.add(unpaired_address)
-
-            for gone_device_address in gone_unpaired_device_addresses:
+            # Clean up any unpaired devices we no longer see
+            for gone_device_address in unpaired_device_addresses - discovered_device_addresses:
                 await self.mqtt_bridge.remove_unpaired_device(gone_device_address)
 
-            await asyncio.sleep(self.update_interval)
\ No newline at end of file
+    def _cancel_connects(self) -> None:
+        for task in self._connect_tasks:
+            task.cancel()
+
+    async def _disconnect_tracked_beds(self) -> None:
+        await asyncio.gather(
+            *(device.disconnect() for device in self.mqtt_bridge.tracked_devices.values()),
+            return_exceptions=True)
+
+    async def _connect_and_track(self, wrapped_bed: MqttSutaBed) -> None:
+        """
+        Connect to a known bed and start tracking it once the connection is up.
+
+        @param wrapped_bed: Bed to connect to
+        """
+        address = wrapped_bed.bed.device.address
+        tracked = False
+        try:
+            async with self._connection_slots:
+                await wrapped_bed.ensure_connected()
+            self._reconnect_backoff.pop(address, None)
+            # We may have listed this bed as unpaired before learning it was known. Retire that entry, along with its
+            # pairing button, just as pairing would. The bridge ignores this if there is no such entry.
+            await self.mqtt_bridge.remove_unpaired_device(key = address)
+            await self.mqtt_bridge.add_tracked_device(key = address, device = wrapped_bed)
+            tracked = True
+        except (BleakError, TimeoutError) as be:
+            previous = self._reconnect_backoff.get(address)
+            delay = self.reconnect_interval_secs if previous is None else min(previous[1] * 2, self.max_reconnect_interval_secs)
+            self._reconnect_backoff[address] = (asyncio.get_running_loop().time() + delay, delay)
+            logger.warning(f"Unable to connect to {address}: {be}, retrying in {delay}s")
+        finally:
+            self._connecting.discard(address)
+            if not tracked:
+                # Nobody else holds this bed, whether we failed, were cancelled, or hit something unexpected
+                await wrapped_bed.close()
@@ -0,0 +1,121 @@
+"""Stand-ins for the BLE bed and MQTT client, so tests need neither hardware nor a broker."""
+
+import asyncio
+
+from aiomqtt import MqttError
+from bleak import BleakError
+
+
+class FakeBleDevice:
+    def __init__(self, address="AA:BB:CC:DD:EE:FF", name="Fake Bed"):
+        self.address = address
+        self.name = name
+
+
+class FakeBed:
+    """
+    Records every movement command it is sent, in place of a BleSutaBed
+    """
+
+    def __init__(self, address="AA:BB:CC:DD:EE:FF"):
+        self.device = FakeBleDevice(address)
+        self.commands = []
+        self.connected = False
+        # Number of upcoming commands which should fail as if the BLE connection had dropped
+        self.fail_commands = 0
+        # Exception for _ensure_connection to raise, if any
+        self.connect_error = None
+
+    def is_connected(self):
+        return self.connected
+
+    async def _ensure_connection(self):
+        if self.connect_error is not None:
+            raise self.connect_error
+        self.connected = True
+
+    async def _command(self, name):
+        if self.fail_commands:
+            self.fail_commands -= 1
+            raise BleakError(f"{name} failed")
+        self.commands.append(name)
+
+    async def raise_head(self):
+        await self._command("raise_head")
+
+    async def lower_head(self):
+        await self._command("lower_head")
+
+    async def raise_feet(self):
+        await self._command("raise_feet")
+
+    async def lower_feet(self):
+        await self._command("lower_feet")
+
+    async def raise_head_and_feet(self):
+        await self._command("raise_head_and_feet")
+
+    async def lower_head_and_feet(self):
+        await self._command("lower_head_and_feet")
+
+    async def flat(self):
+        await self._command("flat")
+
+    async def lounge(self):
+        await self._command("lounge")
+
+
+class FakeTopic:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeMessage:
+    def __init__(self, topic, payload, retain):
+        self.topic = FakeTopic(topic)
+        self.payload = payload
+        self.retain = retain
+
+
+class FakeClient:
+    """
+    Records every message published to it, and plays back messages handed to deliver(), in place of an aiomqtt Client
+    """
+
+    def __init__(self):
+        self.published = []
+        self.subscriptions = []
+        # Make every publish fail, as if the broker connection had dropped
+        self.fail = False
+        self._incoming = asyncio.Queue()
+
+    async def subscribe(self, topic):
+        self.subscriptions.append(topic)
+
+    def deliver(self, topic, payload=b"", retain=False):
+        """
+        Queue a message as if the broker had sent it to us
+        """
+        self._incoming.put_nowait(FakeMessage(topic, payload, retain))
+
+    @property
+    async def messages(self):
+        while True:
+            yield await self._incoming.get()
+
+    async def publish(self, topic, payload=None, retain=False):
+        await asyncio.sleep(0)
+        if self.fail:
+            raise MqttError("Disconnected")
+        self.published.append((topic, payload, retain))
+
+    def topics(self):
+        return [topic for topic, _, _ in self.published]
+
+
+async def settle(rounds=50):
+    """
+    Let every runnable task make progress until nothing is left to do
+    """
+    for _ in range(rounds):
+        await asyncio.sleep(0)
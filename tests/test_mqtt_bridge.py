@@ -0,0 +1,343 @@
+"""Tests for `suta_mqtt_bridge.mqtt_bridge`."""
+
+import asyncio
+import contextlib
+import gc
+import warnings
+
+from aiomqtt import MqttError
+import pytest
+import pytest_asyncio
+
+from suta_mqtt_bridge.consts import json_loads
+from suta_mqtt_bridge.mqtt_bridge import MqttBridge
+from suta_mqtt_bridge.mqtt_suta_bed import MqttSutaBed
+
+from .fakes import FakeBed, FakeClient, settle
+
+
+def make_bridge(cache_file=None) -> MqttBridge:
+    return MqttBridge(
+        mqtt_broker="broker",
+        mqtt_broker_port=1883,
+        mqtt_username="user",
+        mqtt_password="password",
+        discovery_prefix="homeassistant",
+        command_prefix="suta",
+        manufacturer_strings=["suta"],
+        cache_file=cache_file,
+    )
+
+
+@pytest_asyncio.fixture
+async def listening_bridge():
+    """
+    A bridge with its device listener running against a fake client
+    """
+    bridge = make_bridge()
+    client = FakeClient()
+    bridge._client = client
+    listener = asyncio.create_task(bridge.start_device_listener(client))
+    yield bridge, client, listener
+    listener.cancel()
+    with contextlib.suppress(asyncio.CancelledError, MqttError):
+        await listener
+
+
+@pytest_asyncio.fixture
+async def messaging_bridge():
+    """
+    A bridge with both its MQTT and device listeners running against a fake client
+    """
+    bridge = make_bridge()
+    client = FakeClient()
+    bridge._client = client
+    tasks = [
+        asyncio.create_task(bridge.start_mqtt_listener(client)),
+        asyncio.create_task(bridge.start_device_listener(client)),
+    ]
+    await settle()
+    yield bridge, client
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+@pytest.mark.asyncio
+async def test_discovery_is_only_republished_after_being_deleted(messaging_bridge):
+    bridge, client = messaging_bridge
+    bed = MqttSutaBed(FakeBed())
+    entities = bed.get_discovery_entities(bridge.discovery_prefix)
+
+    await bridge.add_tracked_device(bed.bed.device.address, bed)
+    await settle()
+    assert {entity.topic for entity in entities} <= set(client.topics())
+
+    client.published.clear()
+    await bridge.send_entity_discovery(client, bed)
+    assert client.published == []
+
+    # Someone deleted one of the entities, so it needs announcing again
+    deleted_topic = entities[0].topic
+    client.deliver(deleted_topic, b"")
+    await settle()
+    await bridge.send_entity_discovery(client, bed)
+    assert client.topics() == [deleted_topic]
+
+    await bed.close()
+
+
+@pytest.mark.asyncio
+async def test_known_devices_latch_without_any_discovery_messages():
+    bridge = make_bridge()
+    bridge.known_devices_settle_secs = 0.05
+    bridge._last_discovery_msg_at = asyncio.get_running_loop().time()
+
+    await asyncio.wait_for(bridge._latch_known_devices(), timeout=1)
+
+    assert bridge.done_processing_existing_known_devices_event.is_set()
+
+
+@pytest.mark.asyncio
+async def test_known_devices_latch_once_discovery_messages_stop(messaging_bridge):
+    bridge, client = messaging_bridge
+    bridge.known_devices_settle_secs = 0.05
+    bridge._last_discovery_msg_at = asyncio.get_running_loop().time()
+    latch = asyncio.create_task(bridge._latch_known_devices())
+    # A bed which another bridge on the same broker has announced
+    bed = MqttSutaBed(FakeBed())
+    entities = bed.get_discovery_entities(bridge.discovery_prefix)
+
+    for entity in entities:
+        client.deliver(entity.topic, entity.payload, retain=True)
+        await asyncio.sleep(0.01)
+        assert not bridge.done_processing_existing_known_devices_event.is_set()
+
+    await asyncio.wait_for(latch, timeout=1)
+    assert bridge.known_devices == {bed.bed.device.address}
+
+    await bed.close()
+
+
+@pytest.mark.asyncio
+async def test_commands_reach_the_right_bed(messaging_bridge):
+    bridge, client = messaging_bridge
+    beds = [MqttSutaBed(FakeBed("AA:AA:AA:AA:AA:AA")), MqttSutaBed(FakeBed("BB:BB:BB:BB:BB:BB"))]
+    for bed in beds:
+        await bridge.add_tracked_device(bed.bed.device.address, bed)
+    await settle()
+
+    # One subscription covers every bed
+    assert client.subscriptions == ["homeassistant/#", "suta/+/+/set"]
+
+    client.deliver(beds[1].raise_head_button_command_topic())
+    # A bed belonging to some other bridge
+    client.deliver("suta/CC_CC_CC_CC_CC_CC/raise_head/set")
+    await settle()
+
+    assert [bed.target_head_position for bed in beds] == [0, 1]
+
+    for bed in beds:
+        await bed.close()
+
+
+@pytest.mark.asyncio
+async def test_pairing_moves_the_bed_to_tracked_without_closing_it(listening_bridge):
+    bridge, client, _ = listening_bridge
+    bed = MqttSutaBed(FakeBed())
+    address = bed.bed.device.address
+
+    await bridge.add_unpaired_device(address, bed)
+    await settle()
+    assert bridge.unpaired_devices == {address: bed}
+    assert f"homeassistant/button/{bed.sanitised_mac()}/pairing_button/config" in client.topics()
+
+    client.published.clear()
+    await bed.handle_command(bridge, bed.pairing_button_command_topic(), "")
+    await settle()
+
+    assert bridge.unpaired_devices == {}
+    assert bridge.tracked_devices == {address: bed}
+    assert bridge._devices_by_command_topic[bed.raise_head_button_command_topic()] is bed
+    assert not bed.position_update_loop_task.done()
+    assert f"homeassistant/button/{bed.sanitised_mac()}/raise_head_button/config" in client.topics()
+    assert bed.state_topic() in client.topics()
+
+    await bed.close()
+
+
+@pytest.mark.asyncio
+async def test_removing_a_tracked_bed_closes_it(listening_bridge):
+    bridge, client, _ = listening_bridge
+    bed = MqttSutaBed(FakeBed())
+    address = bed.bed.device.address
+
+    await bridge.add_tracked_device(address, bed)
+    await settle()
+    await bridge.remove_tracked_device(address)
+    await settle()
+
+    assert bridge.tracked_devices == {}
+    assert bridge._devices_by_command_topic == {}
+    assert bed.position_update_loop_task.done()
+    assert json_loads(client.published[-2][1])["availability"] == "offline"
+
+
+@pytest.mark.asyncio
+async def test_removing_a_stale_registration_keeps_the_other_routed(listening_bridge):
+    bridge, _, _ = listening_bridge
+    unpaired_bed = MqttSutaBed(FakeBed())
+    tracked_bed = MqttSutaBed(FakeBed())
+    address = tracked_bed.bed.device.address
+
+    await bridge.add_unpaired_device(address, unpaired_bed)
+    await bridge.add_tracked_device(address, tracked_bed)
+    await settle()
+    await bridge.remove_unpaired_device(address)
+    await settle()
+
+    assert bridge.tracked_devices == {address: tracked_bed}
+    assert all(
+        bridge._devices_by_command_topic[command_topic] is tracked_bed
+        for command_topic in tracked_bed.command_topics()
+    )
+    assert unpaired_bed.position_update_loop_task.done()
+    assert not tracked_bed.position_update_loop_task.done()
+
+    await tracked_bed.close()
+
+
+@pytest.mark.asyncio
+async def test_connecting_a_known_bed_retires_its_unpaired_entry(listening_bridge):
+    bridge, client, _ = listening_bridge
+    unpaired_bed = MqttSutaBed(FakeBed())
+    connected_bed = MqttSutaBed(FakeBed())
+    address = connected_bed.bed.device.address
+    pairing_topic = f"homeassistant/button/{unpaired_bed.sanitised_mac()}/pairing_button/config"
+
+    await bridge.add_unpaired_device(address, unpaired_bed)
+    await settle()
+    # As queued by SutaMqttBridge once it has connected to a known bed
+    await bridge.remove_unpaired_device(address)
+    await bridge.add_tracked_device(address, connected_bed)
+    await settle()
+
+    assert bridge.unpaired_devices == {}
+    assert bridge.tracked_devices == {address: connected_bed}
+    assert (pairing_topic, None, False) in client.published
+    # A press of the old pairing button now reaches the connected bed, which is already tracked
+    assert bridge._devices_by_command_topic[unpaired_bed.pairing_button_command_topic()] is connected_bed
+    assert unpaired_bed.position_update_loop_task.done()
+    assert not connected_bed.position_update_loop_task.done()
+
+    await connected_bed.close()
+
+
+@pytest.mark.asyncio
+async def test_adding_over_a_tracked_bed_closes_the_old_one(listening_bridge):
+    bridge, _, _ = listening_bridge
+    old_bed = MqttSutaBed(FakeBed())
+    new_bed = MqttSutaBed(FakeBed())
+    address = old_bed.bed.device.address
+
+    await bridge.add_tracked_device(address, old_bed)
+    await settle()
+    await bridge.add_tracked_device(address, new_bed)
+    await settle()
+
+    assert bridge.tracked_devices == {address: new_bed}
+    assert bridge._devices_by_command_topic[new_bed.raise_head_button_command_topic()] is new_bed
+    assert old_bed.position_update_loop_task.done()
+    assert not new_bed.position_update_loop_task.done()
+
+    await new_bed.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_publish_still_closes_removed_bed(listening_bridge):
+    bridge, client, listener = listening_bridge
+    bed = MqttSutaBed(FakeBed())
+    address = bed.bed.device.address
+    client.fail = True
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        await bridge.add_unpaired_device(address, bed)
+        await bridge.remove_unpaired_device(address)
+        with pytest.raises(MqttError):
+            await asyncio.wait_for(listener, timeout=1)
+        gc.collect()
+
+    assert bed.position_update_loop_task.done()
+    assert not [warning for warning in caught if "never awaited" in str(warning.message)]
+
+
+@pytest.mark.asyncio
+async def test_publish_update_skips_unchanged_state():
+    bridge = make_bridge()
+    bed = MqttSutaBed(FakeBed())
+
+    # Not connected, so nothing goes out and nothing is remembered
+    await bridge.publish_update(bed, online=True)
+    client = FakeClient()
+    bridge._client = client
+
+    await bridge.publish_update(bed, online=True)
+    await bridge.publish_update(bed, online=True)
+    assert len(client.published) == 1
+
+    bed._head_position = 1
+    await bridge.publish_update(bed, online=True)
+    await bridge.publish_update(bed, online=False)
+    assert len(client.published) == 3
+
+    # A failed publish is not remembered, so is retried next time
+    client.fail = True
+    bed._head_position = 2
+    await bridge.publish_update(bed, online=False)
+    client.fail = False
+    await bridge.publish_update(bed, online=False)
+    assert len(client.published) == 4
+
+    await bed.close()
+
+
+def test_cache_file_is_loaded(tmp_path):
+    cache_file = tmp_path / "devices.json"
+    cache_file.write_text('["AA:BB:CC:DD:EE:FF"]')
+
+    bridge = make_bridge(cache_file=str(cache_file))
+
+    assert bridge.known_devices == {"AA:BB:CC:DD:EE:FF"}
+    assert bridge.done_processing_existing_known_devices_event.is_set()
+
+
+@pytest.mark.parametrize("contents", ["", "not json", "null", "5", '{"AA:BB:CC:DD:EE:FF": 1}', '["AA:BB:CC:DD:EE:FF", 1]'])
+def test_bad_cache_file_is_ignored(tmp_path, contents):
+    cache_file = tmp_path / "devices.json"
+    cache_file.write_text(contents)
+
+    bridge = make_bridge(cache_file=str(cache_file))
+
+    assert bridge.known_devices == set()
+    assert not bridge.done_processing_existing_known_devices_event.is_set()
+
+
+def test_missing_cache_file_is_ignored(tmp_path):
+    bridge = make_bridge(cache_file=str(tmp_path / "devices.json"))
+
+    assert bridge.known_devices == set()
+    assert not bridge.done_processing_existing_known_devices_event.is_set()
+
+
+def test_cache_file_is_saved(tmp_path):
+    cache_file = tmp_path / "devices.json"
+    bridge = make_bridge(cache_file=str(cache_file))
+    bridge.known_devices.update({"BB:BB:BB:BB:BB:BB", "AA:AA:AA:AA:AA:AA"})
+
+    bridge._save_known_devices()
+
+    assert json_loads(cache_file.read_bytes()) == ["AA:AA:AA:AA:AA:AA", "BB:BB:BB:BB:BB:BB"]
+    assert make_bridge(cache_file=str(cache_file)).known_devices == bridge.known_devices
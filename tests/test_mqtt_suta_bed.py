@@ -0,0 +1,127 @@
+"""Tests for `suta_mqtt_bridge.mqtt_suta_bed`."""
+
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from suta_mqtt_bridge.mqtt_suta_bed import FEET_POSITION_MAX, HEAD_POSITION_MAX, MqttSutaBed
+
+from .fakes import FakeBed
+
+
+async def wait_until_still(bed: MqttSutaBed) -> None:
+    """
+    Wait for the bed to finish walking to its target
+    """
+    async def _wait():
+        while bed.target_position_changed.is_set():
+            await asyncio.sleep(0.001)
+    await asyncio.wait_for(_wait(), timeout=5)
+
+
+@pytest_asyncio.fixture
+async def bed():
+    wrapped_bed = MqttSutaBed(FakeBed(), step_interval=0.001)
+    yield wrapped_bed
+    await wrapped_bed.close()
+
+
+@pytest.mark.asyncio
+async def test_walks_to_the_target_then_waits(bed):
+    await bed.handle_command(None, bed.head_control_command_topic(), "100")
+    await wait_until_still(bed)
+
+    assert bed.bed.commands == ["raise_head"] * HEAD_POSITION_MAX
+    assert bed._head_position == HEAD_POSITION_MAX
+    assert not bed.position_update_loop_task.done()
+
+
+@pytest.mark.asyncio
+async def test_moves_head_and_feet_separately_in_opposite_directions(bed):
+    bed._head_position = bed.target_head_position = 2
+    await bed.handle_command(None, bed.lower_head_button_command_topic(), "")
+    await bed.handle_command(None, bed.raise_feet_button_command_topic(), "")
+    await wait_until_still(bed)
+
+    assert bed.bed.commands == ["lower_head", "raise_feet"]
+    assert (bed._head_position, bed._feet_position) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_moves_head_and_feet_together_while_both_go_the_same_way(bed):
+    await bed.handle_command(None, bed.head_control_command_topic(), "100")
+    await bed.handle_command(None, bed.feet_control_command_topic(), "100")
+    await wait_until_still(bed)
+
+    assert bed.bed.commands == ["raise_head_and_feet"] * FEET_POSITION_MAX + ["raise_head"] * (HEAD_POSITION_MAX - FEET_POSITION_MAX)
+    assert (bed._head_position, bed._feet_position) == (HEAD_POSITION_MAX, FEET_POSITION_MAX)
+
+    bed.bed.commands.clear()
+    await bed.handle_command(None, bed.head_control_command_topic(), "0")
+    await bed.handle_command(None, bed.feet_control_command_topic(), "95")
+    await wait_until_still(bed)
+
+    assert bed.bed.commands == ["lower_head_and_feet"] + ["lower_head"] * (HEAD_POSITION_MAX - 1)
+    assert (bed._head_position, bed._feet_position) == (0, FEET_POSITION_MAX - 1)
+
+
+@pytest.mark.asyncio
+async def test_clamps_button_presses_at_the_end_stops(bed):
+    await bed.handle_command(None, bed.lower_head_button_command_topic(), "")
+    await bed.handle_command(None, bed.feet_control_command_topic(), "150")
+    await wait_until_still(bed)
+
+    assert bed.target_head_position == 0
+    assert bed.target_feet_position == FEET_POSITION_MAX
+    assert bed.bed.commands == ["raise_feet"] * FEET_POSITION_MAX
+
+
+@pytest.mark.asyncio
+async def test_preset_interrupts_a_walk(bed):
+    await bed.handle_command(None, bed.head_control_command_topic(), "100")
+    while len(bed.bed.commands) < 3:
+        await asyncio.sleep(0.001)
+
+    await bed.handle_command(None, bed.flat_button_command_topic(), "")
+    await wait_until_still(bed)
+
+    assert bed.bed.commands[-1] == "flat"
+    assert bed.bed.commands.count("raise_head") < HEAD_POSITION_MAX
+    assert (bed._head_position, bed.target_head_position) == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_recovers_after_a_ble_error(bed):
+    bed.bed.fail_commands = 1
+    await bed.handle_command(None, bed.raise_head_button_command_topic(), "")
+    await wait_until_still(bed)
+
+    assert bed._head_position == 0
+    assert not bed.position_update_loop_task.done()
+
+    await bed.handle_command(None, bed.raise_head_button_command_topic(), "")
+    await wait_until_still(bed)
+
+    assert bed.bed.commands == ["raise_head", "raise_head"]
+    assert bed._head_position == 2
+
+
+@pytest.mark.asyncio
+async def test_clamps_targets_set_directly(bed):
+    # Targets are public, so may be set without going through the command handlers
+    bed.target_head_position = HEAD_POSITION_MAX + 10
+    bed.target_feet_position = -5
+    bed.target_position_changed.set()
+    await wait_until_still(bed)
+
+    assert bed.target_head_position == HEAD_POSITION_MAX
+    assert bed.target_feet_position == 0
+    assert bed.bed.commands == ["raise_head"] * HEAD_POSITION_MAX
+
+
+@pytest.mark.asyncio
+async def test_close_stops_the_position_task(bed):
+    await bed.close()
+
+    assert bed.position_update_loop_task.done()
@@ -2,23 +2,179 @@
 
 """Tests for `suta_mqtt_bridge` package."""
 
+import asyncio
+import contextlib
+
+from bleak import BleakError
 import pytest
+import pytest_asyncio
+
+from suta_mqtt_bridge.mqtt_suta_bed import MqttSutaBed
+from suta_mqtt_bridge.suta_mqtt_bridge import SutaMqttBridge
+
+from .fakes import FakeBed, FakeClient, settle
+
+
+def make_controller() -> SutaMqttBridge:
+    return SutaMqttBridge(
+        adapter="hci0",
+        update_interval=30,
+        mqtt_broker="broker",
+        mqtt_broker_port=1883,
+        mqtt_username="user",
+        mqtt_password="password",
+        discovery_prefix="homeassistant",
+    )
+
+
+async def connect(controller: SutaMqttBridge, bed: FakeBed) -> MqttSutaBed:
+    wrapped_bed = MqttSutaBed(bed)
+    controller._connecting.add(bed.device.address)
+    await controller._connect_and_track(wrapped_bed)
+    return wrapped_bed
+
+
+@pytest.mark.asyncio
+async def test_connect_failures_back_off_exponentially():
+    controller = make_controller()
+    controller.max_reconnect_interval_secs = 4
+    bed = FakeBed()
+    address = bed.device.address
+    bed.connect_error = BleakError("Out of range")
+
+    delays = []
+    for _ in range(5):
+        wrapped_bed = await connect(controller, bed)
+        delays.append(controller._reconnect_backoff[address][1])
+        assert wrapped_bed.position_update_loop_task.done()
+        assert address not in controller._connecting
+
+    assert delays == [1, 2, 4, 4, 4]
+    assert controller._reconnect_backoff[address][0] > asyncio.get_running_loop().time()
+
+    bed.connect_error = None
+    wrapped_bed = await connect(controller, bed)
+
+    assert address not in controller._reconnect_backoff
+    assert not wrapped_bed.position_update_loop_task.done()
+    # Any unpaired entry for the bed is retired before it is tracked
+    assert controller.mqtt_bridge._device_ops.get_nowait() == ("remove", "unpaired", address, None)
+    assert controller.mqtt_bridge._device_ops.get_nowait() == ("add", "tracked", address, wrapped_bed)
+
+    await wrapped_bed.close()
+
+
+@pytest.mark.asyncio
+async def test_unexpected_connect_error_closes_the_bed():
+    controller = make_controller()
+    bed = FakeBed()
+    bed.connect_error = TypeError("exceptions must derive from BaseException")
+    wrapped_bed = MqttSutaBed(bed)
+
+    with pytest.raises(TypeError):
+        await controller._connect_and_track(wrapped_bed)
+
+    assert wrapped_bed.position_update_loop_task.done()
+    assert bed.device.address not in controller._reconnect_backoff
+
 
+@pytest.mark.asyncio
+async def test_cancelled_connect_closes_the_bed():
+    controller = make_controller()
+    wrapped_bed = MqttSutaBed(FakeBed())
+    # Hold every connection slot, so the connect is stuck waiting when shutdown comes
+    for _ in range(controller.max_concurrent_connections):
+        await controller._connection_slots.acquire()
 
-from suta_mqtt_bridge import suta_mqtt_bridge
+    task = asyncio.create_task(controller._connect_and_track(wrapped_bed))
+    controller._connect_tasks.add(task)
+    await asyncio.sleep(0)
+    controller._cancel_connects()
 
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert wrapped_bed.position_update_loop_task.done()
 
-@pytest.fixture
-def response():
-    """Sample pytest fixture.
 
-    See more at: http://doc.pytest.org/en/latest/fixture.html
+@pytest_asyncio.fixture
+async def polling_controller():
     """
-    # import requests
-    # return requests.get('https://github.com/audreyr/cookiecutter-pypackage')
+    A controller polling every 10ms, forgetting beds after 200ms, with the bridge's device listener running
+    """
+    controller = make_controller()
+    controller.update_interval = 0.01
+    controller.device_timeout_seconds = 0.2
+    bridge = controller.mqtt_bridge
+    bridge._client = FakeClient()
+    tasks = [
+        asyncio.create_task(bridge.start_device_listener(bridge._client)),
+        asyncio.create_task(controller.start_device_polling()),
+    ]
+    yield controller
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+
+
+async def add_tracked_bed(controller: SutaMqttBridge, connected: bool) -> MqttSutaBed:
+    bed = FakeBed()
+    bed.connected = connected
+    wrapped_bed = MqttSutaBed(bed)
+    await controller.mqtt_bridge.add_tracked_device(bed.device.address, wrapped_bed)
+    await settle()
+    return wrapped_bed
+
+
+@pytest.mark.asyncio
+async def test_polling_keeps_a_connected_bed_which_stopped_advertising(polling_controller):
+    wrapped_bed = await add_tracked_bed(polling_controller, connected=True)
+
+    await asyncio.sleep(0.05)
+
+    assert polling_controller.mqtt_bridge.tracked_devices == {wrapped_bed.bed.device.address: wrapped_bed}
+    assert not wrapped_bed.position_update_loop_task.done()
+
+    await wrapped_bed.close()
+
+
+@pytest.mark.asyncio
+async def test_polling_removes_a_disconnected_bed_which_is_not_seen(polling_controller):
+    wrapped_bed = await add_tracked_bed(polling_controller, connected=False)
+
+    await asyncio.sleep(0.05)
+
+    assert polling_controller.mqtt_bridge.tracked_devices == {}
+    assert wrapped_bed.position_update_loop_task.done()
+
+
+@pytest.mark.asyncio
+async def test_polling_reaps_unpaired_beds_once_they_time_out(polling_controller):
+    wrapped_bed = MqttSutaBed(FakeBed())
+    address = wrapped_bed.bed.device.address
+    polling_controller.last_seen[address] = asyncio.get_running_loop().time()
+    await polling_controller.mqtt_bridge.add_unpaired_device(address, wrapped_bed)
+
+    await asyncio.sleep(0.05)
+    assert polling_controller.mqtt_bridge.unpaired_devices == {address: wrapped_bed}
+
+    await asyncio.sleep(0.25)
+    assert polling_controller.mqtt_bridge.unpaired_devices == {}
+    assert address not in polling_controller.last_seen
+    assert wrapped_bed.position_update_loop_task.done()
+
+
+@pytest.mark.asyncio
+async def test_polling_drops_the_backoff_of_expired_beds(polling_controller):
+    address = "AA:BB:CC:DD:EE:FF"
+    now = asyncio.get_running_loop().time()
+    polling_controller.last_seen[address] = now
+    polling_controller._reconnect_backoff[address] = (now + 60, 60)
 
+    await asyncio.sleep(0.05)
+    assert address in polling_controller._reconnect_backoff
 
-def test_content(response):
-    """Sample pytest test function with the pytest fixture as an argument."""
-    # from bs4 import BeautifulSoup
-    # assert 'GitHub' in BeautifulSoup(response.content).title.string
+    await asyncio.sleep(0.25)
+    assert address not in polling_controller.last_seen
+    assert address not in polling_controller._reconnect_backoff